@@ -1,14 +1,16 @@
 #!/usr/bin/env python
 # coding: utf-8
 import logging
+import multiprocessing
 import os
 import sys
 from datetime import datetime
+from typing import Tuple
 
 import click
 import geopandas as gpd
 import numpy as np
-import pandas as pd
+import shapely.wkb
 
 from src.gridlight.electrificationfilter import NightlightFilter
 from src.gridlight.gridlight import (estimate_mem_use, get_targets_costs,
@@ -22,8 +24,28 @@ from src.gridlight.util.raster import get_clipped_data, save_2d_array_as_raster
 
 sys.path.append(os.path.abspath("."))
 from config import get_config
-from src.gridlight.util.remote_storage import (get_default_remote_storage,
-                                               get_develop_remote_storage)
+from src.gridlight.util.remote_storage import pull_files_concurrently
+
+
+def _clip_and_save_ntl(args: Tuple[str, str, bytes, str]) -> str:
+    """Clip a monthly nightlight raster to the AOI and save it as a 2d raster.
+
+    Runs in a worker process, so the AOI is passed as WKB and CRS instead of a GeoDataFrame.
+
+    :param args: Path to the raw nightlight archive, output path, AOI geometry as WKB and AOI CRS
+        as WKT.
+    :return: The output path.
+    """
+    log = logging.getLogger(__name__)
+    full_path, output_path, aoi_wkb, aoi_crs_wkt = args
+    aoi = gpd.GeoDataFrame(geometry=[shapely.wkb.loads(aoi_wkb)], crs=aoi_crs_wkt)
+    with open_raster_in_tar(full_path) as raster:
+        clipped_data, transform = get_clipped_data(raster, aoi, nodata=np.nan)
+        save_2d_array_as_raster(
+            output_path, clipped_data, transform, crs=raster.crs.to_string()
+        )
+    log.info(f"Stored {full_path} as 2d raster in {output_path}.")
+    return output_path
 
 
 @click.command()
@@ -97,13 +119,17 @@ def run_gridfinder(
     log = logging.getLogger(__name__)
     input_files = {}
     if dev_mode:
-        remote_storage = get_develop_remote_storage()
+        remote_storage_config = c.development_remote_storage
     else:
-        remote_storage = get_default_remote_storage()
+        remote_storage_config = c.remote_storage
 
-    ntl_monthly_dates = pd.date_range(start=start_date, end=end_date, freq="MS")
+    # all month starts within the date range, like a date range with month start frequency
+    first_month = np.datetime64(start_date, "M")
+    if start_date.day > 1:
+        first_month += 1
+    ntl_monthly_dates = np.arange(first_month, np.datetime64(end_date, "M") + 1)
     all_ntl_input_monthly_filenames = [
-        f"{date.strftime('%Y%m')}.tgz" for date in ntl_monthly_dates
+        f"{str(month).replace('-', '')}.tgz" for month in ntl_monthly_dates
     ]
 
     all_ntl_input_monthly_full_paths = [
@@ -116,9 +142,10 @@ def run_gridfinder(
         for ntl_filename in all_ntl_input_monthly_filenames
     ]
 
-    for path in all_ntl_input_monthly_full_paths:
-        log.info(f"Pulling nightlight imagery file {path} from storage.")
-        remote_storage.pull(path, "")
+    log.info(
+        f"Pulling {len(all_ntl_input_monthly_full_paths)} nightlight imagery files from storage."
+    )
+    pull_files_concurrently(all_ntl_input_monthly_full_paths, remote_storage_config)
 
     input_files["aoi_in"] = c.datafile_path(
         area_of_interest_data,
@@ -140,9 +167,7 @@ def run_gridfinder(
             power_data, stage=c.PROCESSED, check_existence=False, relative=True
         )
 
-    for _, path in input_files.items():
-        log.info(f"Pulling file {path} from storage.")
-        remote_storage.pull(path, "")
+    pull_files_concurrently(list(input_files.values()), remote_storage_config)
 
     # Define output paths
     ELECTRIFICATION_TARGET_PATH = f"{result_subfolder}/electrification_targets"
@@ -202,19 +227,28 @@ def run_gridfinder(
 
     log.info(f"Preprocess raw nightlight images.")
 
-    output_paths = []
-    for ntl_file, full_path in zip(
-        all_ntl_input_monthly_filenames, all_ntl_input_monthly_full_paths
-    ):
-        output_paths.append(
-            os.path.join(folder_ntl_out, f"{ntl_file[:-4]}.tif")
-        )  # stripping off the .tgz
-        with open_raster_in_tar(full_path) as raster:
-            clipped_data, transform = get_clipped_data(raster, aoi, nodata=np.nan)
-            save_2d_array_as_raster(
-                output_paths[-1], clipped_data, transform, crs=raster.crs.to_string()
-            )
-            log.info(f"Stored {full_path} as 2d raster in {output_paths[-1]}.")
+    aoi_wkb = aoi.geometry[0].wkb
+    aoi_crs_wkt = aoi.crs.to_wkt()
+    clip_jobs = [
+        (
+            full_path,
+            # stripping off the .tgz
+            os.path.join(folder_ntl_out, f"{ntl_file[:-4]}.tif"),
+            aoi_wkb,
+            aoi_crs_wkt,
+        )
+        for ntl_file, full_path in zip(
+            all_ntl_input_monthly_filenames, all_ntl_input_monthly_full_paths
+        )
+    ]
+    # the rasters are independent, but starting processes only pays off for a few of them
+    if len(clip_jobs) > 2:
+        # cpu_count returns None when the number of CPUs can't be determined
+        processes = min(os.cpu_count() or 1, len(clip_jobs))
+        with multiprocessing.Pool(processes=processes) as pool:
+            output_paths = pool.map(_clip_and_save_ntl, clip_jobs)
+    else:
+        output_paths = [_clip_and_save_ntl(job) for job in clip_jobs]
 
     raster_merged, affine, _ = merge_rasters(
         output_paths, percentile=params["percentile"]
@@ -256,8 +290,23 @@ def run_gridfinder(
     est_mem = estimate_mem_use(targets, costs)
     log.info(f"Estimated memory usage of algorithm: {est_mem:.2f} GB")
 
-    dist = optimise(targets, costs, start, jupyter=False, animate=False, affine=affine)
+    # with a cutoff of 0 only the cells with a distance of 0 are needed
+    stop_when_connected = params["cutoff"] == 0
+    dist = optimise(
+        targets,
+        costs,
+        start,
+        jupyter=False,
+        animate=False,
+        affine=affine,
+        stop_when_connected=stop_when_connected,
+    )
     save_2d_array_as_raster(dist_out, dist, affine, DEFAULT_CRS)
+    if stop_when_connected:
+        log.info(
+            f"Stopped once all targets were connected, distances in {dist_out} are "
+            "only exact where they are 0, the cells not reached are NaN."
+        )
 
     guess = threshold_distances(dist, threshold=params["cutoff"])
     save_2d_array_as_raster(guess_out, guess, affine, DEFAULT_CRS)
@@ -9,18 +9,25 @@ Functions:
 """
 
 import os
-import pickle
-import sys
-from heapq import heapify, heappop, heappush
 from math import sqrt
 
 import numpy as np
 import rasterio
+from numba import njit
 
 from src.gridlight.constants import CRS
 from src.gridlight.util.raster import save_2d_array_as_raster
 
-sys.setrecursionlimit(100000)
+_SQRT2 = sqrt(2)
+# row offset, col offset and distance factor of the eight neighbours of a cell
+_NEIGHBOUR_DI = np.array([-1, -1, -1, 0, 0, 1, 1, 1])
+_NEIGHBOUR_DJ = np.array([-1, 0, 1, -1, 1, -1, 0, 1])
+_NEIGHBOUR_FACTOR = np.array([_SQRT2, 1, _SQRT2, 1, 1, _SQRT2, 1, _SQRT2])
+_MIN_HEAP_CAPACITY = 1024
+# share of the raster cells the heap is sized for up front, it grows beyond if needed
+_HEAP_CAPACITY_SHARE = 0.1
+# "nnan" and "ninf" are left out on purpose, unvisited cells are NaN in dist
+_FASTMATH = {"nsz", "arcp", "contract", "afn", "reassoc"}
 
 
 def get_targets_costs(targets_in, costs_in):
@@ -38,25 +45,42 @@ def get_targets_costs(targets_in, costs_in):
     targets : numpy array
         2D array of targets
     costs: numpy array
-        2D array of costs
+        2D array of costs as float32
     start: tuple
         Two-element tuple with row, col of starting point.
     affine : affine.Affine
         Affine transformation for the rasters.
     """
 
-    targets_ra = rasterio.open(targets_in)
-    affine = targets_ra.transform
-    targets = targets_ra.read(1)
-
-    costs_ra = rasterio.open(costs_in)
-    costs = costs_ra.read(1)
-
-    target_list = np.argwhere(targets == 1.0)
-    start = tuple(target_list[0].tolist())
-
-    targets = targets.astype(np.int8)
-    costs = costs.astype(np.float16)
+    with rasterio.open(targets_in) as targets_ra:
+        affine = targets_ra.transform
+
+        # read block by block into the int8 array, with GDAL converting each
+        # block while reading, so the raster is never held in its (usually
+        # wider) file dtype and no cast copy of it is made
+        targets = np.empty(targets_ra.shape, dtype=np.int8)
+        start = None
+        for _, window in targets_ra.block_windows(1):
+            block = targets_ra.read(1, window=window, out_dtype=np.int8)
+            targets[window.toslices()] = block
+
+            # argmax returns the first on-grid cell without collecting all of them
+            first_target = np.argmax(block == 1)
+            if block.flat[first_target] == 1:
+                row, col = divmod(int(first_target), block.shape[1])
+                candidate = (int(window.row_off) + row, int(window.col_off) + col)
+                # blocks can be tiles, so keep the first cell in row-major order
+                if start is None or candidate < start:
+                    start = candidate
+
+    if start is None:
+        raise ValueError(f"No target cells found in {targets_in}.")
+
+    with rasterio.open(costs_in) as costs_ra:
+        # float16 has no hardware arithmetic on CPUs, every operation on it is
+        # emulated via float32, so storing the costs as float16 only costs time.
+        # GDAL converts to float32 while reading, without an intermediate array.
+        costs = costs_ra.read(1, out_dtype=np.float32)
 
     return targets, costs, start, affine
 
@@ -77,17 +101,209 @@ def estimate_mem_use(targets, costs):
         Estimated memory requirement in GB.
     """
 
-    # make sure these match the ones used in optimise below
-    visited = np.zeros_like(targets, dtype=np.int8)
-    dist = np.full_like(costs, np.nan, dtype=np.float32)
-    prev = np.full_like(costs, np.nan, dtype=object)
+    # make sure these match the arrays allocated in optimise below:
+    # float32 dist, int32 prev and the initial int64 heap
+    dist_bytes = costs.size * np.dtype(np.float32).itemsize
+    prev_bytes = costs.size * np.dtype(np.int32).itemsize
+
+    heap_bytes = _initial_heap_capacity(costs.size) * np.dtype(np.int64).itemsize
 
-    est_mem_arr = [targets, costs, visited, dist, prev]
-    est_mem = len(pickle.dumps(est_mem_arr, -1))
+    # optimise works on a float32 copy of costs given in any other dtype
+    if costs.dtype != np.float32:
+        dist_bytes += costs.size * np.dtype(np.float32).itemsize
+
+    est_mem = targets.nbytes + costs.nbytes + dist_bytes + prev_bytes + heap_bytes
 
     return est_mem / 1e9
 
 
+def _initial_heap_capacity(n_cells):
+    """Number of entries to allocate the heap with for a raster of n_cells.
+
+    Allocating a large share up front avoids repeatedly copying the heap
+    while it grows during the first phase of the algorithm.
+    """
+    return max(_MIN_HEAP_CAPACITY, int(n_cells * _HEAP_CAPACITY_SHARE))
+
+
+@njit(cache=True)
+def _heappush(heap, heap_size, key):
+    """Push a key onto the array-backed binary min-heap.
+
+    The heap array is grown by doubling when full, so the (possibly new)
+    array is returned along with the new heap size.
+    """
+    if heap_size == heap.shape[0]:
+        grown = np.empty(2 * heap.shape[0], dtype=np.int64)
+        grown[:heap_size] = heap[:heap_size]
+        heap = grown
+
+    pos = heap_size
+    while pos > 0:
+        parent = (pos - 1) >> 1
+        if heap[parent] <= key:
+            break
+        heap[pos] = heap[parent]
+        pos = parent
+
+    heap[pos] = key
+    return heap, heap_size + 1
+
+
+@njit(cache=True)
+def _heappop(heap, heap_size):
+    """Pop the smallest key from the array-backed binary min-heap.
+
+    Returns the popped key along with the new heap size.
+    """
+    key = heap[0]
+
+    heap_size -= 1
+    if heap_size > 0:
+        last = heap[heap_size]
+
+        pos = 0
+        while True:
+            child = 2 * pos + 1
+            if child >= heap_size:
+                break
+            if child + 1 < heap_size and heap[child + 1] < heap[child]:
+                child += 1
+            if heap[child] >= last:
+                break
+            heap[pos] = heap[child]
+            pos = child
+
+        heap[pos] = last
+
+    return key, heap_size
+
+
+@njit(cache=True)
+def _heap_key(dist_bits, index):
+    """Pack the dist of a cell and its linear index into one int64 heap key.
+
+    The upper 32 bits hold the IEEE 754 bits of the float32 dist, which for
+    non-negative values sort like the floats themselves, the lower 32 bits
+    hold the index. Comparing two keys is then a single integer comparison.
+    Cells are popped by their dist as stored in float32, ties are popped in
+    row-major order. Dists which only differ below float32 precision tie as
+    well, so with few distinct costs the order, and with it the grid, can
+    differ from ordering by the unrounded dists.
+    """
+    return (np.int64(dist_bits[index]) << 32) | index
+
+
+@njit(cache=True, fastmath=_FASTMATH)
+def _optimise_numba(targets, costs, prev, dist, heap, heap_size, counter, targets_left):
+    """Compiled core of optimise, running Dijkstra's algorithm in place.
+
+    Cells that have not been visited yet are NaN in dist. Deriving that from
+    dist rather than keeping a separate visited array means each neighbour
+    lookup touches one cache line less.
+
+    prev holds the linear index (row * ncols + col) of the previous cell on
+    the path. As it is int32 and the heap holds keys from _heap_key, the raster
+    must have fewer than 2**31 cells and costs must not be negative.
+
+    The loop pauses whenever the share of visited cells passes a whole percent,
+    so that the caller can report progress and resume with the returned state.
+    It stops once targets_left drops to 0 and no key with a dist of 0 is left
+    on the heap, pass a negative value for targets_left to explore the whole
+    raster.
+
+    Returns
+    -------
+    heap : numpy array
+        The (possibly grown) heap array.
+    heap_size : int
+        Number of entries left on the heap, 0 once the algorithm has finished.
+    counter : int
+        Number of cells visited so far.
+    targets_left : int
+        Number of targets not yet connected.
+    """
+
+    max_i = costs.shape[0]
+    max_j = costs.shape[1]
+    max_cells = max_i * max_j
+    # smallest counter at which the share of visited cells passes the next
+    # whole percent, so the hot loop only needs an integer comparison
+    percent_done = 100 * counter // max_cells
+    pause_counter = ((percent_done + 1) * max_cells + 99) // 100
+    dist_flat = dist.reshape(-1)
+    dist_bits = dist_flat.view(np.int32)
+    prev_flat = prev.reshape(-1)
+
+    while heap_size > 0:
+        key, heap_size = _heappop(heap, heap_size)
+        current_index = key & 0xFFFFFFFF
+        current_i = current_index // max_j
+        current_j = current_index % max_j
+        current_dist = dist[current_i, current_j]
+        pause = False
+
+        for k in range(8):
+            next_i = current_i + _NEIGHBOUR_DI[k]
+            next_j = current_j + _NEIGHBOUR_DJ[k]
+
+            # ensure we're within bounds
+            if next_i < 0 or next_j < 0 or next_i >= max_i or next_j >= max_j:
+                continue
+
+            # skip if we've already set dist to 0
+            known_dist = dist[next_i, next_j]
+            if known_dist == 0:
+                continue
+
+            # if the location is connected, zero the distance along the
+            # path leading to it and put those cells back on the heap
+            if targets[next_i, next_j]:
+                targets_left -= 1
+                prev[next_i, next_j] = current_index
+
+                loc = next_i * max_j + next_j
+                while loc >= 0 and dist_flat[loc] != 0:
+                    dist_flat[loc] = 0
+                    key = _heap_key(dist_bits, loc)
+                    heap, heap_size = _heappush(heap, heap_size, key)
+                    loc = prev_flat[loc]
+
+            # otherwise it's a normal queue cell
+            else:
+                dist_add = costs[next_i, next_j] * _NEIGHBOUR_FACTOR[k]
+                next_dist = current_dist + dist_add
+
+                if not np.isnan(known_dist):
+                    if next_dist < known_dist:
+                        dist[next_i, next_j] = next_dist
+                        prev[next_i, next_j] = current_index
+                        key = _heap_key(dist_bits, next_i * max_j + next_j)
+                        heap, heap_size = _heappush(heap, heap_size, key)
+
+                else:
+                    dist[next_i, next_j] = next_dist
+                    prev[next_i, next_j] = current_index
+                    key = _heap_key(dist_bits, next_i * max_j + next_j)
+                    heap, heap_size = _heappush(heap, heap_size, key)
+
+                    counter += 1
+                    if counter == pause_counter:
+                        pause = True
+
+        # once all targets are connected, only cells reached at zero cost from
+        # a cell with a dist of 0 (e.g. existing power lines) can still get a
+        # dist of 0. Keys with a dist of 0 pop first, so stop at the first other.
+        if targets_left == 0 and (heap_size == 0 or heap[0] >> 32 != 0):
+            heap_size = 0
+            break
+
+        if pause:
+            break
+
+    return heap, heap_size, counter, targets_left
+
+
 def optimise(
     targets,
     costs,
@@ -97,19 +313,30 @@ def optimise(
     affine=None,
     animate_path=None,
     silent=False,
+    stop_when_connected=False,
 ):
     """Run the Dijkstra algorithm for the supplied arrays.
 
+    The algorithm itself runs in the numba-compiled _optimise_numba, this
+    function prepares the arrays and handles progress output.
+
     Parameters
     ----------
     targets : numpy array
         2D array of targets.
     costs : numpy array
-        2D array of costs.
+        2D array of costs, all of them finite and non-negative, with fewer
+        than 2**31 cells.
     start : tuple
         Two-element tuple with row, col of starting point.
     jupyter : boolean, optional (default False)
         Whether the code is being run from a Jupyter Notebook.
+    stop_when_connected : boolean, optional (default False)
+        Whether to stop as soon as all targets are connected and no further
+        cell can get a distance of 0. The cells with a distance of 0 are the
+        same either way, but the distances of the other
+        cells are then only partially computed and the rest stays NaN, so only
+        use it when nothing but the cells with a distance of 0 is needed.
 
     Returns
     -------
@@ -118,108 +345,57 @@ def optimise(
         on-grid point. Values of 0 imply that cell is part of an MV grid line.
     """
 
-    max_i = costs.shape[0]
-    max_j = costs.shape[1]
-
-    visited = np.zeros_like(targets, dtype=np.int8)
-    dist = np.full_like(costs, np.nan, dtype=np.float32)
+    # prev holds int32 linear indices, which would wrap for larger rasters
+    if costs.size >= 2**31:
+        raise ValueError(f"costs must have fewer than 2**31 cells, got {costs.size}.")
 
-    # want to set this to dtype='int32, int32'
-    # but then the if type(prev_loc) == tuple check will break
-    # becuas it gets instantiated with tuples
-    prev = np.full_like(costs, np.nan, dtype=object)
+    targets = targets.astype(np.int8, copy=False)
+    # numba has no float16 arithmetic, so the costs are processed as float32
+    costs = costs.astype(np.float32, copy=False)
+    # the kernel treats a NaN dist as unvisited, so a NaN cost would make its
+    # cell look unvisited every time it is reached and the search never ends
+    if not np.isfinite(costs).all():
+        raise ValueError("costs must be finite.")
+    # negative dists would sort in reverse order as heap keys, see _heap_key
+    if (costs < 0).any():
+        raise ValueError("costs must not be negative.")
 
-    dist[start] = 0
-
-    #       dist, loc
-    queue = [[0, start]]
-    heapify(queue)
-
-    def zero_and_heap_path(loc):
-        """Zero the location's distance value and follow upstream doing same.
+    # C order, so that the kernel can view it as flat array of float32 bits
+    dist = np.full(costs.shape, np.nan, dtype=np.float32)
 
-        Parameters
-        ----------
-        loc : tuple
-            row, col of current point.
-        """
+    # linear index of the previous cell on the path, -1 if there is none
+    prev = np.full(costs.shape, -1, dtype=np.int32)
 
-        if not dist[loc] == 0:
-            dist[loc] = 0
-            visited[loc] = 1
-
-            heappush(queue, [0, loc])
-            prev_loc = prev[loc]
+    dist[start] = 0
 
-            if type(prev_loc) == tuple:
-                zero_and_heap_path(prev_loc)
+    # keys from _heap_key, the start has a dist of 0 so its key is its index
+    heap = np.empty(_initial_heap_capacity(costs.size), dtype=np.int64)
+    heap[0] = start[0] * costs.shape[1] + start[1]
+    heap_size = 1
 
     counter = 0
     progress = 0
     max_cells = targets.shape[0] * targets.shape[1]
 
-    while len(queue):
-        current = heappop(queue)
-        current_loc = current[1]
-        current_i = current_loc[0]
-        current_j = current_loc[1]
-        current_dist = dist[current_loc]
-
-        for x in range(-1, 2):
-            for y in range(-1, 2):
-                next_i = current_i + x
-                next_j = current_j + y
-                next_loc = (next_i, next_j)
-
-                # ensure we're within bounds
-                if next_i < 0 or next_j < 0 or next_i >= max_i or next_j >= max_j:
-                    continue
-
-                # ensure we're not looking at the same spot
-                if next_loc == current_loc:
-                    continue
-
-                # skip if we've already set dist to 0
-                if dist[next_loc] == 0:
-                    continue
-
-                # if the location is connected
-                if targets[next_loc]:
-                    prev[next_loc] = current_loc
-                    zero_and_heap_path(next_loc)
-
-                # otherwise it's a normal queue cell
-                else:
-                    dist_add = costs[next_loc]
-                    if x == 0 or y == 0:  # if this cell is  up/down/left/right
-                        dist_add *= 1
-                    else:  # or if it's diagonal
-                        dist_add *= sqrt(2)
-
-                    next_dist = current_dist + dist_add
-
-                    if visited[next_loc]:
-                        if next_dist < dist[next_loc]:
-                            dist[next_loc] = next_dist
-                            prev[next_loc] = current_loc
-                            heappush(queue, [next_dist, next_loc])
-
-                    else:
-                        heappush(queue, [next_dist, next_loc])
-                        visited[next_loc] = 1
-                        dist[next_loc] = next_dist
-                        prev[next_loc] = current_loc
-
-                        counter += 1
-                        progress_new = 100 * counter / max_cells
-                        if int(progress_new) > int(progress):
-                            progress = progress_new
-                            message = f"{progress:.2f} %"
-                            if not silent:
-                                print(message)
-                            if animate:
-                                i = int(progress)
-                                path = os.path.join(animate_path, f"arr{i:03d}.tif")
-                                save_2d_array_as_raster(path, dist, affine, CRS)
+    if stop_when_connected:
+        targets_left = np.count_nonzero(targets) - int(targets[start] != 0)
+    else:
+        targets_left = -1
+
+    while heap_size:
+        heap, heap_size, counter, targets_left = _optimise_numba(
+            targets, costs, prev, dist, heap, heap_size, counter, targets_left
+        )
+
+        progress_new = 100 * counter / max_cells
+        if int(progress_new) > int(progress):
+            progress = progress_new
+            message = f"{progress:.2f} %"
+            if not silent:
+                print(message)
+            if animate:
+                i = int(progress)
+                path = os.path.join(animate_path, f"arr{i:03d}.tif")
+                save_2d_array_as_raster(path, dist, affine, CRS)
 
     return dist
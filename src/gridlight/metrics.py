@@ -1,5 +1,6 @@
 """ Metrics module implements calculation of confusion matrix given a prediction and ground truth. """
-from typing import Optional, Tuple, List, Callable
+from contextlib import contextmanager
+from typing import Optional, Tuple, List, Callable, NamedTuple, Union
 from deprecated import deprecated
 
 import fiona
@@ -10,14 +11,81 @@ import geopandas as gp
 from sklearn.metrics import confusion_matrix
 
 import rasterio
+from rasterio.crs import CRS
 from rasterio.enums import Resampling
+from rasterio.transform import array_bounds
 import rasterio.warp
 from rasterio.warp import reproject
 from rasterio.features import rasterize
+from shapely.geometry import box
 
 from gridlight._util import clip_line_poly
 from gridlight.util.raster import get_clipped_data, get_resolution_in_meters
 
+_BLOCK_SIZE_TOLERANCE = 1e-6
+
+
+class RasterView(NamedTuple):
+    """
+    A single band raster held in memory, which can be passed instead of a rasterio.DatasetReader.
+
+    It provides the attributes of a DatasetReader used when computing metrics,
+    so small rasters don't need to be encoded as GeoTIFF to be evaluated.
+    """
+
+    data: np.ndarray
+    transform: Affine
+    crs: CRS
+    nodata: Optional[float] = None
+
+    @property
+    def height(self) -> int:
+        return self.data.shape[0]
+
+    @property
+    def width(self) -> int:
+        return self.data.shape[1]
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return self.data.shape
+
+    @property
+    def bounds(self) -> Tuple[float, float, float, float]:
+        return array_bounds(self.height, self.width, self.transform)
+
+    @property
+    def res(self) -> Tuple[float, float]:
+        # same definition as rasterio.DatasetReader.res, the sizes are never negative
+        a, b, _, d, e, _, _, _, _ = self.transform
+        return np.sqrt(a * a + d * d), np.sqrt(b * b + e * e)
+
+    def read(self, indexes: int = 1) -> np.ndarray:
+        if indexes != 1:
+            raise ValueError(f"A RasterView only has band 1, got {indexes}.")
+        return self.data
+
+
+@contextmanager
+def _open_as_dataset(raster: RasterView):
+    """Opens the in-memory raster as rasterio dataset, for functions which need a real dataset."""
+    # GeoTIFF has no boolean type
+    data = raster.data.astype(np.uint8) if raster.data.dtype == bool else raster.data
+    with rasterio.MemoryFile() as memory_file:
+        with memory_file.open(
+            driver="GTiff",
+            height=raster.height,
+            width=raster.width,
+            count=1,
+            dtype=data.dtype,
+            crs=raster.crs,
+            transform=raster.transform,
+            nodata=raster.nodata,
+        ) as dst:
+            dst.write(data, 1)
+        with memory_file.open() as dataset:
+            yield dataset
+
 
 @deprecated(
     reason="Function is deprecated and will be removed in the next release 1.3.0"
@@ -25,7 +93,7 @@ from gridlight.util.raster import get_clipped_data, get_resolution_in_meters
 )
 def eval_metrics(
     ground_truth_lines: gp.GeoDataFrame,
-    raster_guess_reader: rasterio.DatasetReader,
+    raster_guess_reader: Union[rasterio.DatasetReader, RasterView],
     cell_size_in_meters: Optional[float] = None,
     aoi: Optional[gp.GeoDataFrame] = None,
     metrics: List[Callable] = [confusion_matrix],
@@ -36,7 +104,8 @@ def eval_metrics(
 
     :param ground_truth_lines: A gp.GeoDataFrame object which contains LineString objects as shapes
                                representing the grid lines.
-    :param raster_guess_reader: A rasterio.DatasetReader object which contains the raster of predicted grid lines.
+    :param raster_guess_reader: A rasterio.DatasetReader or RasterView object which contains the raster
+                                of predicted grid lines.
                                 Pixel values marked with 1 are considered a prediction of a grid line.
     :param cell_size_in_meters: The cell_size_in_meters parameter controls the size of one prediction in meters.
                                 E.g. the original raster has a pixel size of 100m x 100m.
@@ -65,7 +134,7 @@ def eval_metrics(
 
 def get_binary_arrays(
     ground_truth_lines: gp.GeoDataFrame,
-    raster_guess_reader: rasterio.DatasetReader,
+    raster_guess_reader: Union[rasterio.DatasetReader, RasterView],
     cell_size_in_meters: Optional[float] = None,
     aoi: Optional[gp.GeoDataFrame] = None,
 ):
@@ -74,7 +143,8 @@ def get_binary_arrays(
 
     :param ground_truth_lines: A gp.GeoDataFrame object which contains LineString objects as shapes
                                representing the grid lines.
-    :param raster_guess_reader: A rasterio.DatasetReader object which contains the raster of predicted grid lines.
+    :param raster_guess_reader: A rasterio.DatasetReader or RasterView object which contains the raster
+                                of predicted grid lines.
                                 Pixel values marked with 1 are considered a prediction of a grid line.
     :param cell_size_in_meters: The cell_size_in_meters parameter controls the size of one prediction in meters.
                                 E.g. the original raster has a pixel size of 100m x 100m.
@@ -91,10 +161,16 @@ def get_binary_arrays(
     # perform clipping of raster and ground truth in case aoi parameter is provided
     if aoi is not None:
         ground_truth_lines = clip_line_poly(ground_truth_lines, aoi)
-        raster, affine = get_clipped_data(raster_guess_reader, aoi)
+        if isinstance(raster_guess_reader, RasterView):
+            with _open_as_dataset(raster_guess_reader) as dataset:
+                raster, affine = get_clipped_data(dataset, aoi)
+        else:
+            raster, affine = get_clipped_data(raster_guess_reader, aoi)
         raster = raster.squeeze(axis=0)
     else:
         raster, affine = raster_guess_reader.read(1), raster_guess_reader.transform
+    # binarize once, as uint8 since the rasterio functions don't support booleans
+    raster = (raster == 1).astype(np.uint8)
 
     # perform down-sampling in case cell_size_in_meters parameter is provided.
     if cell_size_in_meters is not None:
@@ -119,9 +195,68 @@ def get_binary_arrays(
     return raster.flatten(), raster_ground_truth.flatten()
 
 
+def eval_confusion_matrix_batch(
+    ground_truth_lines: gp.GeoDataFrame,
+    raster_guesses: np.ndarray,
+    transform: Affine,
+) -> np.ndarray:
+    """
+    Calculates the confusion matrices of several grid line predictions on the same grid at once.
+
+    The ground truth is rasterized only once and each matrix is derived from a few array reductions,
+    which is much cheaper than calling get_binary_arrays and confusion_matrix per prediction.
+
+    :param ground_truth_lines: A gp.GeoDataFrame object which contains LineString objects as shapes
+                               representing the grid lines.
+    :param raster_guesses: A 3D array of shape (N, height, width) stacking N rasters of predicted grid lines,
+                           all sharing the given transform.
+                           Pixel values marked with 1 are considered a prediction of a grid line.
+    :param transform: The affine transformation of the rasters.
+
+    :returns: An array of shape (N, 2, 2) holding one confusion matrix per prediction,
+              in the layout of sklearn.metrics.confusion_matrix, [[tn, fp], [fn, tp]].
+    """
+    if raster_guesses.ndim != 3:
+        raise ValueError(
+            f"Expected a 3D array of stacked rasters, got shape {raster_guesses.shape}."
+        )
+    guesses = raster_guesses == 1
+    ground_truth = (
+        _rasterize_geo_dataframe(guesses[0], ground_truth_lines, transform) == 1
+    )
+
+    true_positives = np.count_nonzero(guesses & ground_truth, axis=(1, 2))
+    false_positives = np.count_nonzero(guesses, axis=(1, 2)) - true_positives
+    false_negatives = np.count_nonzero(ground_truth) - true_positives
+    true_negatives = (
+        ground_truth.size - true_positives - false_positives - false_negatives
+    )
+
+    return np.stack(
+        [true_negatives, false_positives, false_negatives, true_positives], axis=1
+    ).reshape(-1, 2, 2)
+
+
 def _perform_scaling(
     raster_array: np.array, affine_mat: Affine, scaling_factor: float, crs: str
 ) -> Tuple[np.array, Affine]:
+    if raster_array.dtype == bool:
+        # rasterio can't reproject booleans
+        raster_array = raster_array.astype(np.uint8)
+
+    # down-sampling by a whole number of pixels which divides the raster shape
+    # is a plain block maximum, which needs neither GDAL nor a second buffer.
+    # The tolerance absorbs the rounding of pixel sizes converted to meters.
+    block_size = round(1 / scaling_factor)
+    if (
+        block_size > 1
+        and abs(1 / scaling_factor - block_size) < _BLOCK_SIZE_TOLERANCE
+        and raster_array.shape[0] % block_size == 0
+        and raster_array.shape[1] % block_size == 0
+    ):
+        raster_out_transform = affine_mat * Affine.scale(block_size)
+        return _block_max(raster_array, block_size), raster_out_transform
+
     shape = (
         1,
         round(raster_array.shape[0] * scaling_factor),
@@ -147,6 +282,15 @@ def _perform_scaling(
     return raster_out.squeeze(axis=0), raster_out_transform
 
 
+def _block_max(raster_array: np.array, block_size: int) -> np.array:
+    """Maximum of each block_size x block_size block, the shape must be divisible by block_size."""
+    height, width = raster_array.shape
+    blocks = raster_array.reshape(
+        height // block_size, block_size, width // block_size, block_size
+    )
+    return blocks.max(axis=(1, 3))
+
+
 def _rasterize_geo_dataframe(
     raster_array: np.array, data_frame: gp.GeoDataFrame, transform: Affine
 ) -> np.array:
@@ -155,13 +299,26 @@ def _rasterize_geo_dataframe(
     assert (
         len(raster_array.shape) == 2
     ), f"Expected 2D array, got shape {raster_array.shape}."
-    data_rows = [row.geometry for _, row in data_frame.iterrows()]
+    # only rasterize the shapes whose bounding box overlaps the raster, the
+    # spatial index answers that without touching the other geometries
+    height, width = raster_array.shape
+    # from all four corners, so that rotated transforms are covered as well
+    xs, ys = transform * (
+        np.array([0, width, 0, width]),
+        np.array([0, 0, height, height]),
+    )
+    extent = box(xs.min(), ys.min(), xs.max(), ys.max())
+    geometries = data_frame.geometry.values[data_frame.sindex.query(extent)]
+    if len(geometries) == 0:
+        # rasterize refuses an empty list of shapes
+        return np.zeros(raster_array.shape, dtype=np.uint8)
+
     new_raster = rasterize(
-        data_rows,
+        [(geometry, 1) for geometry in geometries],
         out_shape=raster_array.shape,
         fill=0,
-        default_value=1,
         all_touched=True,
         transform=transform,
+        dtype=np.uint8,
     )
     return new_raster
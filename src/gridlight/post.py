@@ -16,11 +16,10 @@ from pathlib import Path
 from typing import Union, Optional, List
 
 import numpy as np
-import pandas as pd
 import geopandas as gpd
+from numba import njit
 from skimage.morphology import skeletonize
-import shapely.wkt
-from shapely.geometry import Point, LineString
+import shapely
 import rasterio
 from rasterio.features import rasterize
 from rasterio.transform import xy
@@ -71,6 +70,50 @@ def thin(guess_in: np.ndarray):
     return guess_skel.astype("int32")
 
 
+@njit(cache=True)
+def _scan_skeleton(arr):
+    """Find all pairs of neighbouring cells with value 1.
+
+    :param arr: Output from thin().
+    :return: int32 array of shape (n, 4), each row holding row, col of a cell
+        and row, col of its neighbour. Every pair is contained once.
+    """
+    max_row = arr.shape[0]
+    max_col = arr.shape[1]
+
+    # each cell can start at most four pairs, see the offsets below
+    n_cells = 0
+    for row in range(max_row):
+        for col in range(max_col):
+            if arr[row, col] == 1:
+                n_cells += 1
+    lines = np.empty((4 * n_cells, 4), dtype=np.int32)
+
+    n_lines = 0
+    for row in range(max_row):
+        for col in range(max_col):
+            if arr[row, col] != 1:
+                continue
+            # only look forward (right and the row below), so that each pair
+            # is found from exactly one of its two cells
+            for i, j in ((0, 1), (1, -1), (1, 0), (1, 1)):
+                next_row = row + i
+                next_col = col + j
+
+                # ensure we're within bounds
+                if next_row >= max_row or next_col < 0 or next_col >= max_col:
+                    continue
+
+                if arr[next_row, next_col] == 1:
+                    lines[n_lines, 0] = row
+                    lines[n_lines, 1] = col
+                    lines[n_lines, 2] = next_row
+                    lines[n_lines, 3] = next_col
+                    n_lines += 1
+
+    return lines[:n_lines]
+
+
 def raster_to_lines(arr: np.ndarray, affine, crs):
     """
     Convert thinned raster to linestring geometry.
@@ -80,50 +123,17 @@ def raster_to_lines(arr: np.ndarray, affine, crs):
     :param crs: Coordinate reference system.
     :return: Geopandas GeoDataFrame with geometries of lines
     """
-    max_row = arr.shape[0]
-    max_col = arr.shape[1]
-    lines = []
-
-    for row in range(0, max_row):
-        for col in range(0, max_col):
-            loc = (row, col)
-            if arr[loc] == 1:
-                for i in range(-1, 2):
-                    for j in range(-1, 2):
-                        next_row = row + i
-                        next_col = col + j
-                        next_loc = (next_row, next_col)
-
-                        # ensure we're within bounds
-                        # ensure we're not looking at the same spot
-                        if (
-                            next_row < 0
-                            or next_col < 0
-                            or next_row >= max_row
-                            or next_col >= max_col
-                            or next_loc == loc
-                        ):
-                            continue
-
-                        if arr[next_loc] == 1:
-                            line = (loc, next_loc)
-                            rev = (line[1], line[0])
-                            if line not in lines and rev not in lines:
-                                lines.append(line)
-
-    real_lines = []
-    for line in lines:
-        real = (xy(affine, line[0][0], line[0][1]), xy(affine, line[1][0], line[1][1]))
-        real_lines.append(real)
-
-    shapes = []
-    for line in real_lines:
-        shapes.append(LineString([Point(line[0]), Point(line[1])]).wkt)
-
-    guess_gdf = pd.DataFrame(shapes)
-    geometry = guess_gdf[0].map(shapely.wkt.loads)
-    guess_gdf = guess_gdf.drop(0, axis=1)
-    guess_gdf = gpd.GeoDataFrame(guess_gdf, crs=crs, geometry=geometry)
+    lines = _scan_skeleton(arr)
+
+    start_x, start_y = xy(affine, lines[:, 0], lines[:, 1])
+    end_x, end_y = xy(affine, lines[:, 2], lines[:, 3])
+    # shape (n, 2, 2): for each line the coordinates of its two points
+    coords = np.stack(
+        [np.column_stack([start_x, start_y]), np.column_stack([end_x, end_y])],
+        axis=1,
+    )
+
+    guess_gdf = gpd.GeoDataFrame(geometry=shapely.linestrings(coords), crs=crs)
 
     guess_gdf["same"] = 0
     guess_gdf = guess_gdf.dissolve(by="same")
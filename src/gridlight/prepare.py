@@ -29,6 +29,16 @@ from rasterio.merge import merge
 from src.gridlight.util.raster import get_clipped_data
 from src.gridlight.electrificationfilter import ElectrificationFilter
 
+_HISTOGRAM_BINS = 256
+# The histogram bins are evenly spaced in asinh(radiance / _HISTOGRAM_SCALE), which is
+# linear well below _HISTOGRAM_SCALE and logarithmic well above it, over a fixed range
+# of radiances. A single gas flare then does not widen the bins of the dim pixels.
+_HISTOGRAM_SCALE = 0.01
+_HISTOGRAM_RANGE = (-100.0, 100_000.0)
+# Below this number of rasters, stacking them as float32 takes less memory
+# than a per-pixel uint16 histogram with _HISTOGRAM_BINS bins.
+_HISTOGRAM_MIN_FILES = 128
+
 
 def combine_rasters_into_single_file(
     rasters: List[Union[str, Path, rasterio.DatasetReader]],
@@ -63,6 +73,10 @@ def merge_rasters(file_paths: List[Union[str, Path]], percentile=70):
     """Merge a set of monthly rasters keeping the nth percentile value.
 
     Used to remove transient features from time-series data.
+    For long time series (at least 128 rasters) the rasters are not stacked in memory,
+    instead the percentile is approximated from a per-pixel histogram with 256 bins,
+    which is accurate to about 0.005 around the usual threshold of 0.1 and to about 5 %
+    for bright pixels.
 
     :param file_paths: List of paths to raster files that are to be merged.
     :type file_paths: List[str], List[Path]
@@ -73,6 +87,10 @@ def merge_rasters(file_paths: List[Union[str, Path]], percentile=70):
 
     """
 
+    tif_files = [file for file in file_paths if file.endswith(".tif")]
+    if len(tif_files) >= _HISTOGRAM_MIN_FILES:
+        return _merge_rasters_histogram(tif_files, percentile)
+
     affine = None
     crs = None
     rasters = []
@@ -93,6 +111,62 @@ def merge_rasters(file_paths: List[Union[str, Path]], percentile=70):
     return raster_merged, affine, crs
 
 
+def _merge_rasters_histogram(
+    file_paths: List[Union[str, Path]], percentile=70, bins=_HISTOGRAM_BINS
+):
+    """Approximate the per-pixel percentile of rasters with a streaming histogram.
+
+    Only one raster is held in memory at a time, next to the histogram counts, and every
+    raster is read once. The bins are evenly spaced in asinh(value / _HISTOGRAM_SCALE)
+    over the fixed _HISTOGRAM_RANGE, so they are narrow around 0, where the
+    electrification threshold lies, and grow in proportion to the value for bright
+    pixels. Values outside the range fall into the outermost bins. The result is the
+    centre of the bin holding the percentile. Pixels which are NaN in any raster are NaN
+    in the result, like with np.percentile.
+
+    :param file_paths: List of paths to raster files that are to be merged, fewer than 65536.
+    :param percentile: Percentile value to use when merging.
+    :param bins: Number of histogram bins.
+    """
+    affine = None
+    crs = None
+    counts = None
+    low, high = np.arcsinh(np.array(_HISTOGRAM_RANGE) / _HISTOGRAM_SCALE)
+    bin_width = (high - low) / bins
+
+    # every pixel of every raster falls into exactly one bin
+    for file in file_paths:
+        with rasterio.open(file) as ntl_rd:
+            raster = ntl_rd.read(1)
+            if counts is None:
+                affine = ntl_rd.transform
+                crs = ntl_rd.crs
+                counts = np.zeros((bins,) + raster.shape, dtype=np.uint16)
+                flat_counts = counts.reshape(bins, -1)
+                pixel_index = np.arange(raster.size)
+                has_nan = np.zeros(raster.shape, dtype=bool)
+        is_nan = np.isnan(raster)
+        has_nan |= is_nan
+        scaled = np.arcsinh(np.where(is_nan, 0, raster) / _HISTOGRAM_SCALE)
+        bin_index = np.floor((scaled - low) / bin_width)
+        bin_index = np.clip(bin_index, 0, bins - 1).astype(np.intp)
+        flat_counts[bin_index.ravel(), pixel_index] += 1
+
+    # index of the percentile value among the sorted values of a pixel
+    rank = round(percentile / 100 * (len(file_paths) - 1))
+    np.cumsum(counts, axis=0, out=counts)
+    # the number of bins with at most rank values below their upper edge
+    # is the index of the bin containing the value at position rank
+    percentile_bin = np.zeros(counts.shape[1:], dtype=np.intp)
+    for cumulative_counts in counts:
+        percentile_bin += cumulative_counts <= rank
+
+    raster_merged = _HISTOGRAM_SCALE * np.sinh(low + (percentile_bin + 0.5) * bin_width)
+    raster_merged[has_nan] = np.nan
+
+    return raster_merged, affine, crs
+
+
 def prepare_ntl(
     ntl: np.ndarray,
     affine: gpd.GeoDataFrame,
@@ -115,13 +189,19 @@ def prepare_ntl(
     :type threshold: float, optional (default 0.1.)
     :param upsample_by: The factor by which to upsample the input raster, applied to both axes
         (so a value of 2 results in a raster 4 times bigger). This is to
-        allow the roads detail to be captured in higher resolution. (Default value = 2)
+        allow the roads detail to be captured in higher resolution. A value of 1 skips
+        the upsampling. (Default value = 2)
     :type upsample_by: int, optional (default 2.)
 
     """
     ntl_filtered = electrification_predictor.predict(ntl)
-    ntl_interp, newaff = _upsample(affine, ntl_filtered, upsample_by)
-    ntl_thresh = (ntl_interp[0] >= threshold).astype(float)
+    if upsample_by == 1:
+        # reprojecting onto the same grid would only copy the raster
+        ntl_interp, newaff = ntl_filtered, affine
+    else:
+        ntl_interp, newaff = _upsample(affine, ntl_filtered, upsample_by)
+        ntl_interp = ntl_interp[0]
+    ntl_thresh = (ntl_interp >= threshold).astype(float)
     return ntl_thresh, newaff
 
 
@@ -95,6 +95,6 @@ def get_resolution_in_meters(reader: rasterio.io.DatasetReader) -> tuple:
         pixel_size_x = transform[0]
         pixel_size_y = -transform[4]
     else:
-        pixel_size_x, pixel_size_y = reader.res[0], -reader.res[1]
+        pixel_size_x, pixel_size_y = reader.res
 
     return pixel_size_x, pixel_size_y
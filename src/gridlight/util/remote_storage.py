@@ -1,8 +1,10 @@
 import logging.handlers
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from os.path import exists
 from typing import List
 
-from accsr.remote_storage import RemoteStorage
+from accsr.remote_storage import RemoteStorage, RemoteStorageConfig
 from libcloud.storage.types import ObjectDoesNotExistError
 
 from config import get_config
@@ -52,6 +54,38 @@ def download_files_from_gcp(
                 log.info(f"File {filename} not found on GCP.")
 
 
+def pull_files_concurrently(
+    remote_paths: List[str],
+    remote_storage_config: RemoteStorageConfig,
+    max_workers: int = 8,
+):
+    """
+    Pulls multiple files from the remote storage using a pool of threads.
+
+    The downloads are bound by network round trips, so running them concurrently
+    speeds them up almost linearly. Each thread creates its own RemoteStorage
+    since the underlying libcloud connection must not be shared between threads.
+
+    :param remote_paths: The paths of the files to pull, relative to the storage base path.
+    :param remote_storage_config: The configuration used to create the remote storage objects.
+    :param max_workers: The maximal number of concurrent downloads.
+    """
+    if not remote_paths:
+        return
+
+    thread_local = threading.local()
+
+    def _pull(path: str):
+        if not hasattr(thread_local, "remote_storage"):
+            thread_local.remote_storage = RemoteStorage(remote_storage_config)
+        log.info(f"Pulling file {path} from storage.")
+        thread_local.remote_storage.pull(path, "")
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(remote_paths))) as pool:
+        # consume the results so that exceptions from the workers are raised here
+        list(pool.map(_pull, remote_paths))
+
+
 def upload_files_to_gcp(all_filenames: List[str], remote_storage: RemoteStorage):
     for filename in all_filenames:
 
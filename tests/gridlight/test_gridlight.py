@@ -0,0 +1,204 @@
+import os
+from heapq import heappop, heappush
+from itertools import product
+from math import sqrt
+
+import numpy as np
+import pytest
+from affine import Affine
+
+from src.gridlight.gridlight import estimate_mem_use, get_targets_costs, optimise
+from src.gridlight.util.raster import save_2d_array_as_raster
+
+
+def reference_optimise(targets, costs, start):
+    """Pure-Python version of optimise, with the same float32 dist and heap order"""
+    max_i, max_j = costs.shape
+    dist = np.full(costs.shape, np.nan, dtype=np.float32)
+    prev = np.full(costs.shape, -1, dtype=np.int64)
+    dist[start] = 0
+    queue = [(0.0, start[0] * max_j + start[1])]
+
+    while queue:
+        _, current_index = heappop(queue)
+        current_i, current_j = divmod(current_index, max_j)
+        current_dist = float(dist[current_i, current_j])
+
+        for di, dj in product((-1, 0, 1), repeat=2):
+            if di == dj == 0:
+                continue
+            next_i = current_i + di
+            next_j = current_j + dj
+            if next_i < 0 or next_j < 0 or next_i >= max_i or next_j >= max_j:
+                continue
+            next_index = next_i * max_j + next_j
+            known_dist = dist[next_i, next_j]
+            if known_dist == 0:
+                continue
+
+            if targets[next_i, next_j]:
+                prev[next_i, next_j] = current_index
+                loc = next_index
+                while loc >= 0 and dist.flat[loc] != 0:
+                    dist.flat[loc] = 0
+                    heappush(queue, (0.0, loc))
+                    loc = prev.flat[loc]
+            else:
+                factor = 1 if di == 0 or dj == 0 else sqrt(2)
+                next_dist = current_dist + float(costs[next_i, next_j]) * factor
+                if np.isnan(known_dist) or next_dist < known_dist:
+                    dist[next_i, next_j] = next_dist
+                    prev[next_i, next_j] = current_index
+                    heappush(queue, (float(dist[next_i, next_j]), next_index))
+
+    return dist
+
+
+@pytest.fixture()
+def corridor_targets():
+    targets = np.zeros((3, 5), dtype=np.int8)
+    targets[1, 0] = 1
+    targets[1, 4] = 1
+    return targets
+
+
+def test_optimise_connects_targets(corridor_targets):
+    costs = np.ones(corridor_targets.shape, dtype=np.float32)
+    dist = optimise(corridor_targets, costs, (1, 0), silent=True)
+
+    assert dist.dtype == np.float32
+    assert np.all(dist[1] == 0)
+    assert np.all(dist[0] > 0)
+    assert np.all(dist[2] > 0)
+
+
+def test_optimise_follows_cheap_path(corridor_targets):
+    costs = np.full(corridor_targets.shape, 10, dtype=np.float32)
+    costs[0, :] = 0.1
+    dist = optimise(corridor_targets, costs, (1, 0), silent=True)
+
+    assert np.all(dist[0, 1:4] == 0)
+    assert np.all(dist[1, 1:4] > 0)
+
+
+@pytest.mark.parametrize("with_power_line", [False, True])
+def test_optimise_stop_when_connected_keeps_grid(with_power_line):
+    rng = np.random.default_rng(0)
+    targets = np.zeros((20, 20), dtype=np.int8)
+    targets[2, 3] = 1
+    targets[10, 12] = 1
+    targets[17, 5] = 1
+    costs = rng.uniform(0.1, 1.0, size=targets.shape).astype(np.float32)
+    if with_power_line:
+        # existing power lines cost nothing, see prepare_roads
+        costs[18, :] = 0
+
+    dist_full = optimise(targets, costs, (2, 3), silent=True)
+    dist_early = optimise(targets, costs, (2, 3), silent=True, stop_when_connected=True)
+
+    np.testing.assert_array_equal(dist_early == 0, dist_full == 0)
+    assert np.all(dist_full[targets == 1] == 0)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_optimise_matches_reference_on_tied_costs(seed):
+    # few distinct road weights, so many cells are reached with equal dists
+    rng = np.random.default_rng(seed)
+    targets = (rng.random((60, 70)) < 0.01).astype(np.int8)
+    targets[0, 0] = 1
+    costs = rng.choice([0.1, 0.25, 1.0], size=targets.shape).astype(np.float32)
+
+    dist = optimise(targets, costs, (0, 0), silent=True)
+
+    expected = reference_optimise(targets, costs, (0, 0))
+    np.testing.assert_array_equal(dist, expected)
+
+
+def test_optimise_rejects_negative_costs(corridor_targets):
+    costs = np.ones(corridor_targets.shape, dtype=np.float32)
+    costs[0, 2] = -1
+
+    with pytest.raises(ValueError):
+        optimise(corridor_targets, costs, (1, 0), silent=True)
+
+
+def test_optimise_rejects_rasters_with_too_many_cells():
+    # broadcast views, so the test needs no memory for 2**31 cells
+    targets = np.broadcast_to(np.int8(0), (2**16, 2**15))
+    costs = np.broadcast_to(np.float32(1), targets.shape)
+
+    with pytest.raises(ValueError):
+        optimise(targets, costs, (0, 0), silent=True)
+
+
+def test_optimise_rejects_non_finite_costs():
+    targets = np.zeros((5, 5), dtype=np.int8)
+    targets[0, 0] = 1
+    targets[4, 4] = 1
+    costs = np.ones(targets.shape, dtype=np.float32)
+    costs[2, 1:3] = np.nan
+
+    with pytest.raises(ValueError):
+        optimise(targets, costs, (0, 0), silent=True)
+
+
+def test_optimise_stop_when_connected_follows_zero_costs():
+    targets = np.zeros((3, 6), dtype=np.int8)
+    targets[0, 0] = 1
+    targets[0, 2] = 1
+    costs = np.ones(targets.shape, dtype=np.float32)
+    costs[1, 3:] = 0
+
+    dist = optimise(targets, costs, (0, 0), silent=True, stop_when_connected=True)
+
+    assert np.all(dist[1, 3:] == 0)
+
+
+def test_optimise_handles_paths_longer_than_recursion_limit():
+    length = 150_000
+    targets = np.zeros((1, length), dtype=np.int8)
+    targets[0, 0] = 1
+    targets[0, -1] = 1
+    costs = np.ones(targets.shape, dtype=np.float32)
+
+    dist = optimise(targets, costs, (0, 0), silent=True)
+
+    assert np.all(dist == 0)
+
+
+def test_estimate_mem_use():
+    targets = np.zeros((10, 10), dtype=np.int8)
+    costs = np.zeros((10, 10), dtype=np.float32)
+
+    # targets + costs + dist + prev + heap with the minimal capacity
+    expected_bytes = 100 + 400 + 400 + 400 + 1024 * 8
+    assert estimate_mem_use(targets, costs) == pytest.approx(expected_bytes / 1e9)
+
+
+def test_estimate_mem_use_counts_float32_copy_of_costs():
+    targets = np.zeros((10, 10), dtype=np.int8)
+    costs = np.zeros((10, 10), dtype=np.float16)
+
+    # targets + costs + float32 costs copy + dist + prev + heap
+    expected_bytes = 100 + 200 + 400 + 400 + 400 + 1024 * 8
+    assert estimate_mem_use(targets, costs) == pytest.approx(expected_bytes / 1e9)
+
+
+def test_get_targets_costs(tmp_path, corridor_targets):
+    targets_path = os.path.join(tmp_path, "targets.tif")
+    costs_path = os.path.join(tmp_path, "costs.tif")
+    save_2d_array_as_raster(
+        targets_path, corridor_targets.astype(float), Affine.identity(), "EPSG:4326"
+    )
+    save_2d_array_as_raster(
+        costs_path, np.full((3, 5), 0.5), Affine.identity(), "EPSG:4326"
+    )
+
+    targets, costs, start, affine = get_targets_costs(targets_path, costs_path)
+
+    assert targets.dtype == np.int8
+    np.testing.assert_array_equal(targets, corridor_targets)
+    assert costs.dtype == np.float32
+    np.testing.assert_array_equal(costs, np.full((3, 5), 0.5))
+    assert start == (1, 0)
+    assert affine == Affine.identity()
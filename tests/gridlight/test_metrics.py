@@ -1,39 +1,48 @@
 """
 Test suite for the metrics module
 """
-import os
-from typing import Optional
+from typing import Optional, Tuple
 
 import pytest
 
 import rasterio
 from affine import Affine
+from rasterio.crs import CRS
 import numpy as np
 import geopandas as gp
-from shapely.geometry import LineString, Polygon
+import shapely
 import rasterio.warp
 from sklearn.metrics import confusion_matrix
 
-from src.gridlight.metrics import get_binary_arrays, _perform_scaling
+from src.gridlight.metrics import (
+    RasterView,
+    eval_confusion_matrix_batch,
+    get_binary_arrays,
+    _perform_scaling,
+)
+
+# the cases are independent, see the "parallel" marker in pytest.ini
+pytestmark = pytest.mark.parallel
 
 TRANSFORM = Affine(1 + 1e-10, 0.0, 0.0, 0.0, 1 + 1e-10, 0.0)
+RASTER_CRS = CRS.from_string("EPSG:3857")
 
 
-def store_tif_file(file_path, raster: np.array) -> str:
-    with rasterio.open(
-        str(file_path),
-        "w",
+def store_in_memory_tif(raster: np.array) -> rasterio.MemoryFile:
+    # GeoTIFF has no boolean type
+    raster = raster.astype(np.uint8)
+    memory_file = rasterio.MemoryFile()
+    with memory_file.open(
         driver="GTiff",
         height=raster.shape[0],
         width=raster.shape[1],
         count=1,
         dtype=raster.dtype,
-        crs="EPSG:3857",
+        crs=RASTER_CRS,
         transform=TRANSFORM,
     ) as dst:
         dst.write(raster, 1)
-        dst.close()
-    return str(file_path)
+    return memory_file
 
 
 CORRECT_GUESS = np.array(
@@ -45,20 +54,7 @@ CORRECT_GUESS = np.array(
         [0, 1, 0, 0, 0, 0],
         [0, 0, 0, 0, 0, 0],
     ],
-    dtype=np.float32,
-)
-
-
-CORRECT_GUESS_BUT_SHIFTED_LEFT = np.array(
-    [
-        [0, 0, 0, 0, 0, 0],
-        [1, 0, 0, 0, 0, 0],
-        [1, 0, 0, 0, 0, 0],
-        [1, 0, 0, 0, 0, 0],
-        [1, 0, 0, 0, 0, 0],
-        [0, 0, 0, 0, 0, 0],
-    ],
-    dtype=np.float32,
+    dtype=np.bool_,
 )
 
 PARTIALLY_CORRECT_GUESS = np.array(
@@ -70,182 +66,185 @@ PARTIALLY_CORRECT_GUESS = np.array(
         [0, 0, 0, 0, 0, 0],
         [0, 0, 0, 0, 0, 0],
     ],
-    dtype=np.float32,
+    dtype=np.bool_,
 )
 
-PARTIALLY_CORRECT_GUESS_BUT_SHIFTED_LEFT = np.array(
-    [
-        [0, 0, 0, 0, 0, 0],
-        [1, 0, 0, 0, 0, 0],
-        [1, 0, 0, 0, 0, 0],
-        [1, 0, 0, 0, 0, 0],
-        [0, 0, 0, 0, 0, 0],
-        [0, 0, 0, 0, 0, 0],
-    ],
-    dtype=np.float32,
-)
+
+def shift_left(raster: np.array) -> np.array:
+    """Shifts the raster one column to the left, the last column is filled with zeros"""
+    shifted = np.zeros_like(raster)
+    shifted[:, :-1] = raster[:, 1:]
+    return shifted
+
+
+CORRECT_GUESS_BUT_SHIFTED_LEFT = shift_left(CORRECT_GUESS)
+PARTIALLY_CORRECT_GUESS_BUT_SHIFTED_LEFT = shift_left(PARTIALLY_CORRECT_GUESS)
+
+GUESSES = {
+    "correct": CORRECT_GUESS,
+    "correct_shifted_left": CORRECT_GUESS_BUT_SHIFTED_LEFT,
+    "partially_correct": PARTIALLY_CORRECT_GUESS,
+    "partially_correct_shifted_left": PARTIALLY_CORRECT_GUESS_BUT_SHIFTED_LEFT,
+}
 
 
 # The value don't map the indices in the grid directly
 # The later used rasterize function start counting the indices form one instead of zero
 # Also the LineString coordinates need to be transposed
-GROUND_TRUTH = gp.GeoDataFrame(
-    index=[0], geometry=[LineString([[2, 2], [2, 3], [2, 4], [2, 5]])], crs="EPSG:3857"
-)
+GROUND_TRUTH = '{"type": "LineString", "coordinates": [[2, 2], [2, 3], [2, 4], [2, 5]]}'
 
-SAMPLE_AOI = gp.GeoDataFrame(
-    index=[0], geometry=[Polygon([[0, 0], [4, 0], [4, 4], [0, 4]])], crs="EPSG:3857"
+SAMPLE_AOI = (
+    '{"type": "Polygon", "coordinates": [[[0, 0], [4, 0], [4, 4], [0, 4], [0, 0]]]}'
 )
 
 
-@pytest.fixture()
-def ground_truth_lines():
-    return GROUND_TRUTH
-
-
-@pytest.fixture()
-def sample_aoi():
-    return SAMPLE_AOI
+def geojson_to_geo_dataframe(geojson: str) -> gp.GeoDataFrame:
+    return gp.GeoDataFrame(
+        index=[0], geometry=[shapely.from_geojson(geojson)], crs="EPSG:3857"
+    )
 
 
-@pytest.fixture()
-def correct_guess(raster_saver) -> str:
-    return raster_saver(CORRECT_GUESS, "correct_guess.tif")
+def as_tuple(matrix: np.array) -> Tuple[int, int, int, int]:
+    """The binary confusion matrix as plain ints in sklearn's order (tn, fp, fn, tp)"""
+    return tuple(matrix.ravel().tolist())
 
 
-@pytest.fixture()
-def correct_guess_but_shifted_left(raster_saver) -> str:
-    return raster_saver(
-        CORRECT_GUESS_BUT_SHIFTED_LEFT, "correct_guess_but_shifted_left.tif"
-    )
+@pytest.fixture(scope="session")
+def ground_truth_lines() -> gp.GeoDataFrame:
+    return geojson_to_geo_dataframe(GROUND_TRUTH)
 
 
-@pytest.fixture()
-def partially_correct_guess(raster_saver) -> str:
-    return raster_saver(PARTIALLY_CORRECT_GUESS, "partially_correct_guess.tif")
+@pytest.fixture(scope="session")
+def sample_aoi() -> gp.GeoDataFrame:
+    return geojson_to_geo_dataframe(SAMPLE_AOI)
 
 
 @pytest.fixture()
-def partially_correct_guess_but_shifted_left(raster_saver) -> str:
-    return raster_saver(
-        PARTIALLY_CORRECT_GUESS_BUT_SHIFTED_LEFT,
-        "partially_correct_guess_but_shifted_left.tif",
-    )
+def correct_guess() -> RasterView:
+    return RasterView(CORRECT_GUESS, TRANSFORM, RASTER_CRS)
 
 
-@pytest.fixture()
-def raster_saver(tmpdir_factory):
-    """Saves Raster as TIF file"""
+@pytest.fixture(scope="session")
+def raster_guess(request) -> RasterView:
+    """The guess with the id given by indirect parametrization, cached per id"""
+    return RasterView(GUESSES[request.param], TRANSFORM, RASTER_CRS)
 
-    def _raster_saver(raster: np.array, file_name: str):
-        tmp_folder = tmpdir_factory.mktemp("tmp_raster")
-        path = os.path.join(tmp_folder, file_name)
-        store_tif_file(path, raster)
-        return rasterio.open(path)
 
-    return _raster_saver
+@pytest.fixture(scope="session")
+def correct_guess_dataset() -> rasterio.DatasetReader:
+    """The correct guess as GeoTIFF, to cover the rasterio dataset code path"""
+    with store_in_memory_tif(CORRECT_GUESS) as memory_file:
+        with memory_file.open() as dataset:
+            yield dataset
 
 
 @pytest.mark.parametrize(
     ["raster_guess", "cell_size_in_meters", "expected_confusion_matrix"],
     [
-        (pytest.lazy_fixture("correct_guess"), None, np.array([[32, 0], [0, 4]])),
-        (
-            pytest.lazy_fixture("correct_guess_but_shifted_left"),
-            None,
-            np.array([[28, 4], [4, 0]]),
-        ),
-        (
-            pytest.lazy_fixture("partially_correct_guess"),
-            None,
-            np.array([[32, 0], [1, 3]]),
-        ),
-        (
-            pytest.lazy_fixture("partially_correct_guess_but_shifted_left"),
-            None,
-            np.array([[29, 3], [4, 0]]),
-        ),
-        (pytest.lazy_fixture("correct_guess"), 2.0, np.array([[6, 0], [0, 3]])),
-        (
-            pytest.lazy_fixture("correct_guess_but_shifted_left"),
-            2.0,
-            np.array([[6, 0], [0, 3]]),
-        ),
-        (
-            pytest.lazy_fixture("partially_correct_guess"),
-            2.0,
-            np.array([[6, 0], [1, 2]]),
-        ),
-        (
-            pytest.lazy_fixture("partially_correct_guess_but_shifted_left"),
-            2.0,
-            np.array([[6, 0], [1, 2]]),
-        ),
-        (pytest.lazy_fixture("correct_guess"), 3.0, np.array([[2, 0], [0, 2]])),
+        ("correct", None, (32, 0, 0, 4)),
+        ("correct_shifted_left", None, (28, 4, 4, 0)),
+        ("partially_correct", None, (32, 0, 1, 3)),
+        ("partially_correct_shifted_left", None, (29, 3, 4, 0)),
+        ("correct", 2.0, (6, 0, 0, 3)),
+        ("correct_shifted_left", 2.0, (6, 0, 0, 3)),
+        ("partially_correct", 2.0, (6, 0, 1, 2)),
+        ("partially_correct_shifted_left", 2.0, (6, 0, 1, 2)),
+        ("correct", 3.0, (2, 0, 0, 2)),
     ],
+    indirect=["raster_guess"],
 )
 def test_on_confusion_matrix(
     ground_truth_lines: gp.GeoDataFrame,
-    raster_guess: rasterio.DatasetReader,
+    raster_guess: RasterView,
     cell_size_in_meters: Optional[int],
-    expected_confusion_matrix: np.array,
+    expected_confusion_matrix: Tuple[int, int, int, int],
 ):
     y_pred, y_true = get_binary_arrays(
         ground_truth_lines, raster_guess, cell_size_in_meters
     )
-    assert np.array_equal(
-        confusion_matrix(y_true=y_true, y_pred=y_pred), expected_confusion_matrix
+    matrix = confusion_matrix(y_true=y_true, y_pred=y_pred)
+    assert as_tuple(matrix) == expected_confusion_matrix
+
+
+def test_confusion_matrix_batch(ground_truth_lines: gp.GeoDataFrame):
+    expected_confusion_matrices = {
+        "correct": (32, 0, 0, 4),
+        "correct_shifted_left": (28, 4, 4, 0),
+        "partially_correct": (32, 0, 1, 3),
+        "partially_correct_shifted_left": (29, 3, 4, 0),
+    }
+    raster_guesses = np.stack([GUESSES[name] for name in expected_confusion_matrices])
+    matrices = eval_confusion_matrix_batch(
+        ground_truth_lines, raster_guesses, TRANSFORM
     )
+    assert matrices.shape == (len(expected_confusion_matrices), 2, 2)
+    for matrix, expected_confusion_matrix in zip(
+        matrices, expected_confusion_matrices.values()
+    ):
+        assert as_tuple(matrix) == expected_confusion_matrix
 
 
 def test_up_sampling_fails(
-    correct_guess: rasterio.DatasetReader, ground_truth_lines: gp.GeoDataFrame
+    correct_guess: RasterView, ground_truth_lines: gp.GeoDataFrame
 ):
     with pytest.raises(ValueError):
         get_binary_arrays(ground_truth_lines, correct_guess, 0.5)
 
 
+@pytest.mark.parametrize("cell_size_in_meters", [None, 2.0])
+@pytest.mark.parametrize("with_aoi", [False, True])
+def test_dataset_and_raster_view_agree(
+    correct_guess_dataset: rasterio.DatasetReader,
+    correct_guess: RasterView,
+    ground_truth_lines: gp.GeoDataFrame,
+    sample_aoi: gp.GeoDataFrame,
+    cell_size_in_meters: Optional[float],
+    with_aoi: bool,
+):
+    aoi = sample_aoi if with_aoi else None
+    y_pred, y_true = get_binary_arrays(
+        ground_truth_lines, correct_guess_dataset, cell_size_in_meters, aoi=aoi
+    )
+    y_pred_view, y_true_view = get_binary_arrays(
+        ground_truth_lines, correct_guess, cell_size_in_meters, aoi=aoi
+    )
+    assert np.array_equal(y_pred, y_pred_view)
+    assert np.array_equal(y_true, y_true_view)
+
+
 @pytest.mark.parametrize(
     ["raster_guess", "cell_size_in_meters", "expected_confusion_matrix"],
     [
-        (pytest.lazy_fixture("correct_guess"), None, np.array([[13, 0], [0, 3]])),
-        (pytest.lazy_fixture("correct_guess"), 2.0, np.array([[2, 0], [0, 2]])),
+        ("correct", None, (13, 0, 0, 3)),
+        ("correct", 2.0, (2, 0, 0, 2)),
     ],
+    indirect=["raster_guess"],
 )
 def test_aoi_on_confusion_matrix(
-    raster_guess: rasterio.DatasetReader,
+    raster_guess: RasterView,
     cell_size_in_meters: int,
     sample_aoi: gp.GeoDataFrame,
     ground_truth_lines: gp.GeoDataFrame,
-    expected_confusion_matrix: np.array,
+    expected_confusion_matrix: Tuple[int, int, int, int],
 ):
     y_pred, y_true = get_binary_arrays(
         ground_truth_lines, raster_guess, cell_size_in_meters, aoi=sample_aoi
     )
-    assert np.array_equal(
-        confusion_matrix(y_true=y_true, y_pred=y_pred), expected_confusion_matrix
-    )
+    matrix = confusion_matrix(y_true=y_true, y_pred=y_pred)
+    assert as_tuple(matrix) == expected_confusion_matrix
 
 
 @pytest.mark.parametrize(
     ["raster_guess", "scaling_factor"],
     [
-        (
-            pytest.lazy_fixture("correct_guess"),
-            1,
-        ),
-        (
-            pytest.lazy_fixture("correct_guess"),
-            2,
-        ),
-        (
-            pytest.lazy_fixture("correct_guess"),
-            3,
-        ),
+        ("correct", 1),
+        ("correct", 2),
+        ("correct", 3),
     ],
+    indirect=["raster_guess"],
 )
 def test_affine_matrix_after_scaling(
-    raster_guess: rasterio.DatasetReader,
+    raster_guess: RasterView,
     scaling_factor: int,
     ground_truth_lines: gp.GeoDataFrame,
 ):
@@ -262,3 +261,15 @@ def test_affine_matrix_after_scaling(
     assert affine.d == new_affine.d
     assert affine.e == new_affine.e * scaling_factor
     assert affine.f == new_affine.f
+
+
+def test_down_sampling_by_whole_pixels_takes_block_maximum():
+    raster, new_affine = _perform_scaling(
+        CORRECT_GUESS,
+        affine_mat=TRANSFORM,
+        scaling_factor=0.5,
+        crs=RASTER_CRS.to_string(),
+    )
+    expected = np.array([[1, 0, 0], [1, 0, 0], [1, 0, 0]])
+    assert np.array_equal(raster, expected)
+    assert new_affine == TRANSFORM * Affine.scale(2)
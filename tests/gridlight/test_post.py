@@ -1,6 +1,6 @@
 import pytest
 from numpy.testing import assert_array_equal
-from src.gridlight.post import threshold_distances
+from src.gridlight.post import _scan_skeleton, threshold_distances
 import numpy as np
 
 
@@ -19,3 +19,11 @@ def test_threshold_distances(raster, threshold, expected):
     assert_array_equal(
         threshold_distances(np.array(raster), threshold), np.array(expected)
     )
+
+
+def test_scan_skeleton_finds_each_pair_once():
+    skeleton = np.array([[1, 1, 0], [0, 1, 0], [0, 0, 0]], dtype=np.int32)
+    assert_array_equal(
+        _scan_skeleton(skeleton),
+        np.array([[0, 0, 0, 1], [0, 0, 1, 1], [0, 1, 1, 1]], dtype=np.int32),
+    )
@@ -0,0 +1,74 @@
+import os
+
+import numpy as np
+import pytest
+from affine import Affine
+
+from src.gridlight.electrificationfilter import ElectrificationFilter
+from src.gridlight.prepare import _merge_rasters_histogram, prepare_ntl
+from src.gridlight.util.raster import save_2d_array_as_raster
+
+
+@pytest.fixture()
+def monthly_rasters(tmp_path):
+    rng = np.random.default_rng(42)
+    rasters = rng.uniform(0.0, 10.0, size=(5, 3, 3))
+    rasters[2, 0, 0] = np.nan
+    paths = []
+    for i, raster in enumerate(rasters):
+        path = os.path.join(tmp_path, f"{i}.tif")
+        save_2d_array_as_raster(path, raster, Affine.identity(), "EPSG:4326")
+        paths.append(path)
+    return rasters, paths
+
+
+@pytest.fixture()
+def skewed_monthly_rasters(tmp_path):
+    # dim background with a single gas flare, far brighter than everything else
+    rng = np.random.default_rng(42)
+    rasters = rng.gamma(0.5, 0.02, size=(130, 20, 20)).astype(np.float32)
+    rasters[:, 7, 11] = 3000.0
+    paths = []
+    for i, raster in enumerate(rasters):
+        path = os.path.join(tmp_path, f"{i}.tif")
+        save_2d_array_as_raster(path, raster, Affine.identity(), "EPSG:4326")
+        paths.append(path)
+    return rasters, paths
+
+
+def test_merge_rasters_histogram_approximates_percentile(monthly_rasters):
+    rasters, paths = monthly_rasters
+
+    merged, _, _ = _merge_rasters_histogram(paths, percentile=50)
+
+    expected = np.percentile(rasters, 50, axis=0)
+    assert np.isnan(merged[0, 0])
+    np.testing.assert_allclose(merged[1:], expected[1:], rtol=0.06)
+    np.testing.assert_allclose(merged[0, 1:], expected[0, 1:], rtol=0.06)
+
+
+def test_merge_rasters_histogram_keeps_dim_pixels_apart(skewed_monthly_rasters):
+    rasters, paths = skewed_monthly_rasters
+
+    merged, _, _ = _merge_rasters_histogram(paths, percentile=70)
+
+    expected = np.percentile(rasters, 70, axis=0, method="nearest")
+    np.testing.assert_allclose(merged, expected, rtol=0.06, atol=0.001)
+    np.testing.assert_array_equal(merged >= 0.1, expected >= 0.1)
+
+
+class _IdentityFilter(ElectrificationFilter):
+    def predict(self, data: np.ndarray):
+        return data
+
+
+def test_prepare_ntl_without_upsampling():
+    ntl = np.array([[0.0, 0.2], [0.05, 0.1]])
+    affine = Affine(0.5, 0.0, 10.0, 0.0, -0.5, 20.0)
+
+    ntl_thresh, new_affine = prepare_ntl(
+        ntl, affine, _IdentityFilter(), threshold=0.1, upsample_by=1
+    )
+
+    np.testing.assert_array_equal(ntl_thresh, np.array([[0.0, 1.0], [0.0, 1.0]]))
+    assert new_affine == affine
@@ -5,10 +5,15 @@ import geopandas as gpd
 import numpy as np
 import pytest
 import rasterio
+from affine import Affine
 from rasterio import DatasetReader
 from shapely.geometry import Point, Polygon, MultiPolygon
 
-from src.gridlight.util.raster import save_2d_array_as_raster, get_clipped_data
+from src.gridlight.util.raster import (
+    save_2d_array_as_raster,
+    get_clipped_data,
+    get_resolution_in_meters,
+)
 
 
 @pytest.fixture()
@@ -52,6 +57,14 @@ def test_save_2d_array_as_raster_savedArrayIsCorrect(
         assert dataset.crs.to_string() == default_crs
 
 
+def test_get_resolution_in_meters_isPositive(two_dim_array, output_file):
+    save_2d_array_as_raster(
+        output_file, two_dim_array, Affine(2.0, 0.0, 0.0, 0.0, -3.0, 0.0), "EPSG:3857"
+    )
+    with rasterio.open(output_file) as dataset:
+        assert get_resolution_in_meters(dataset) == (2.0, 3.0)
+
+
 def test_get_clipped_data_inputValidation(sample_ntl_raster, caplog):
     point_geodf = gpd.GeoDataFrame({"geometry": [Point(1.0, -1.0)]})
     coords = ((0.0, 0.0), (0.0, 1.0), (1.0, 1.0), (1.0, 0.0), (0.0, 0.0))